@@ -12,7 +12,7 @@ from nilearn.connectome import ConnectivityMeasure
 from numpy.random import default_rng
 from scipy.stats import skew, kurtosis
 from sklearn.preprocessing import RobustScaler
-from torch_geometric.data import InMemoryDataset, Data
+from torch_geometric.data import InMemoryDataset, Data, Batch
 
 from utils import Normalisation, ConnType, AnalysisType, EncodingStrategy, DatasetType
 from utils_datasets import DESIKAN_COMPLETE_TS, DESIKAN_TRACKS, UKB_IDS_PATH, UKB_PHENOTYPE_PATH, \
@@ -133,6 +133,33 @@ def create_thresholded_graph(adj_array: np.ndarray, threshold: int, num_nodes: i
     return nx.from_numpy_array(adj_array, create_using=nx.DiGraph)
 
 
+class PinnableBatch(Batch):
+    """
+    PyG's Batch, but with a pin_memory() method. torch's DataLoader (with pin_memory=True) only pins custom types
+    which define it, so that the copies to the GPU can then be done asynchronously (non_blocking=True).
+    """
+
+    def pin_memory(self):
+        return self.apply(lambda x: x.pin_memory())
+
+    @staticmethod
+    def from_data_list(data_list, follow_batch=[]):
+        batch = Batch.from_data_list(data_list, follow_batch)
+        batch.__class__ = PinnableBatch
+        return batch
+
+
+class BrainDataLoader(torch.utils.data.DataLoader):
+    """
+    Same as PyG's DataLoader, but collating the graphs into a PinnableBatch.
+    """
+
+    def __init__(self, dataset, batch_size=1, shuffle=False, follow_batch=[], **kwargs):
+        super(BrainDataLoader, self).__init__(
+            dataset, batch_size, shuffle,
+            collate_fn=lambda data_list: PinnableBatch.from_data_list(data_list, follow_batch), **kwargs)
+
+
 class BrainDataset(InMemoryDataset, ABC):
     def __init__(self, root, target_var: str, num_nodes: int, threshold: int, connectivity_type: ConnType,
                  normalisation: Normalisation, analysis_type: AnalysisType,  edge_weights: bool, time_length: int,
@@ -165,6 +192,14 @@ class BrainDataset(InMemoryDataset, ABC):
         # Download to `self.raw_dir`.
         pass
 
+    def get_stacked_features(self) -> torch.Tensor:
+        """
+        Node features of all graphs in the (whole) dataset as a single contiguous tensor of shape (num_graphs,
+        num_nodes, num_features), without any copy or collation. Meant for models which do not use the graph
+        structure (e.g., the encoders), as every graph has exactly num_nodes nodes.
+        """
+        return self.data.x.view(-1, self.num_nodes, self.data.x.shape[-1])
+
 
 class HCPDataset(BrainDataset):
     def __init__(self, root, target_var: str, num_nodes: int, threshold: int, connectivity_type: ConnType,
@@ -432,51 +467,60 @@ class FlattenCorrsDataset(InMemoryDataset):
         # Download to `self.raw_dir`.
         pass
 
-    def __generate_flatten_from_ts(self, ts: np.ndarray) -> np.ndarray:
+    def __generate_flatten_from_ts(self, ts_list: list) -> np.ndarray:
+        """
+        :param ts_list: List of timeseries, each in format TS x N
+        :return: Array of shape (len(ts_list), N * (N - 1) / 2), one flatten upper triangle per timeseries
+        """
         conn_measure = ConnectivityMeasure(
             kind='correlation',
             vectorize=False)
 
-        corr_arr = conn_measure.fit_transform([ts])
-        assert corr_arr.shape == (1, 68, 68)
-        corr_arr = corr_arr[0]
+        # All the timeseries at once, instead of one ConnectivityMeasure per timeseries
+        corr_arr = conn_measure.fit_transform(ts_list)
+        assert corr_arr.shape == (len(ts_list), 68, 68)
 
-        # Getting upper triangle only (without diagonal)
-        flatten_array = corr_arr[np.triu_indices(self.num_nodes, k=1)]
-        assert flatten_array.shape == (int(self.num_nodes * (self.num_nodes - 1) / 2),)
+        # Getting upper triangle only (without diagonal), for all the correlation matrices with a single gather
+        triu_rows, triu_cols = np.triu_indices(self.num_nodes, k=1)
+        flatten_array = corr_arr[:, triu_rows, triu_cols]
+        assert flatten_array.shape == (len(ts_list), int(self.num_nodes * (self.num_nodes - 1) / 2))
 
         return flatten_array
 
+    def __get_hcp_data_objects(self, person: int, info_df: pd.DataFrame) -> list:
+        idx_to_filter = np.concatenate((np.arange(0, 34), np.arange(49, 83)))
 
-    def __get_hcp_data_object(self, person: int, direction: str, ind: int) -> Data:
-        info_df = pd.read_csv(PEOPLE_DEMOGRAPHICS_PATH).set_index('Subject')
+        ts_list = []
+        for direction in ['1_LR', '1_RL', '2_LR', '2_RL']:
+            ts = np.genfromtxt(get_desikan_ts_path(person, direction))
 
-        idx_to_filter = np.concatenate((np.arange(0, 34), np.arange(49, 83)))
-        ts = np.genfromtxt(get_desikan_ts_path(person, direction))
+            ts = ts.T
+            ts = ts[:, idx_to_filter]
+            assert ts.shape[0] == 1200
+            assert ts.shape[1] == 68
+            ts_list.append(ts)
 
-        ts = ts.T
-        ts = ts[:, idx_to_filter]
-        assert ts.shape[0] == 1200
-        assert ts.shape[1] == 68
+        flatten_arrays = self.__generate_flatten_from_ts(ts_list)
 
-        flatten_array = self.__generate_flatten_from_ts(ts)
-        x = torch.tensor(flatten_array, dtype=torch.float)
+        data_list: list[Data] = []
+        for ind, flatten_array in enumerate(flatten_arrays):
+            x = torch.tensor(flatten_array, dtype=torch.float)
 
-        data = Data(x=x)
-        data.hcp_id = torch.tensor([person])
-        data.index = torch.tensor([ind])
-        data.sex = torch.tensor([info_df.loc[person, 'Gender']], dtype=torch.float)
+            data = Data(x=x)
+            data.hcp_id = torch.tensor([person])
+            data.index = torch.tensor([ind])
+            data.sex = torch.tensor([info_df.loc[person, 'Gender']], dtype=torch.float)
+            data_list.append(data)
 
-        return data
-    
-    def __get_ukb_data_object(self, person: int) -> Data:
+        return data_list
+
+    def __get_ukb_data_object(self, person: int, main_covars: pd.DataFrame) -> Data:
         if person in [1663368, 3443644]:
             # No information in Covars file
             raise PersonNotFound
 
-        main_covars = pd.read_csv(UKB_PHENOTYPE_PATH).set_index('ID')
         ts = np.loadtxt(f'{UKB_TIMESERIES_PATH}/UKB{person}_ts_raw.txt', delimiter=',')
-        
+
         if ts.shape[0] < 84:
             raise PersonNotFound
         elif ts.shape[1] == 523:
@@ -488,7 +532,7 @@ class FlattenCorrsDataset(InMemoryDataset):
         # For normalisation part and connectivity
         ts = ts.T
 
-        flatten_array = self.__generate_flatten_from_ts(ts)
+        flatten_array = self.__generate_flatten_from_ts([ts])[0]
 
         x = torch.tensor(flatten_array, dtype=torch.float)
 
@@ -504,23 +548,24 @@ class FlattenCorrsDataset(InMemoryDataset):
         # Read data into huge `Data` list.
         data_list: list[Data] = []
 
+        # Covariates only read once, instead of for every single person
         if self.dataset_type == DatasetType.UKB:
             filtered_people = np.load(UKB_IDS_PATH)
+            main_covars = pd.read_csv(UKB_PHENOTYPE_PATH).set_index('ID')
         else:
             filtered_people = sorted(list(set(DESIKAN_COMPLETE_TS).intersection(set(DESIKAN_TRACKS))))
+            info_df = pd.read_csv(PEOPLE_DEMOGRAPHICS_PATH).set_index('Subject')
 
         for person in filtered_people:
 
             if self.dataset_type == DatasetType.UKB:
                 try:
-                    data = self.__get_ukb_data_object(person)
+                    data = self.__get_ukb_data_object(person, main_covars=main_covars)
                     data_list.append(data)
                 except PersonNotFound:
                     continue
             else: # HCP
-                for ind, direction in enumerate(['1_LR', '1_RL', '2_LR', '2_RL']):
-                    data = self.__get_hcp_data_object(person, ind=ind, direction=direction)
-                    data_list.append(data)
+                data_list.extend(self.__get_hcp_data_objects(person, info_df=info_df))
 
         data, slices = self.collate(data_list)
         torch.save((data, slices), self.processed_paths[0])
@@ -1,18 +1,28 @@
 import argparse
+import inspect
+import os
+
 import torch
 import torch.utils.data
 from sklearn.model_selection import ParameterGrid
 from torch import nn, optim
 from torch.nn import functional as F
-from torch_geometric.data import DataLoader
-from torch_geometric.utils import to_dense_batch
 from torchvision import datasets, transforms
 from torchvision.utils import save_image
 import numpy as np
 
 from datasets import BrainDataset
 from utils import ConnType, ConvStrategy, Normalisation, PoolingStrategy, create_name_for_brain_dataset, \
-    StratifiedGroupKFold, merge_y_and_others, create_name_for_encoder_model, create_best_encoder_name, EncodingStrategy
+    StratifiedGroupKFold, merge_y_and_others, create_name_for_encoder_model, create_best_encoder_name, EncodingStrategy, \
+    get_autocast_context, get_grad_scaler
+
+
+def reparameterize_with_kl(mu, logvar):
+    # exp(logvar) is calculated only once, for both the std and the KL divergence (see loss_function_vae)
+    var = logvar.exp()
+    z = mu + torch.randn_like(var) * var.sqrt()
+    kdl_loss = -0.5 * torch.sum(1 + logvar - mu * mu - var)
+    return z, kdl_loss
 
 
 class VAE(nn.Module):
@@ -20,29 +30,27 @@ class VAE(nn.Module):
         super(VAE, self).__init__()
 
         self.MODEL_NAME = '3layerVAE'
-        self.MODEL_VERSION = 1.0
+        self.MODEL_VERSION = 1.1
         self.EMBED_SIZE = 50
         self.activation = nn.Tanh()
 
 
         self.fc12 = nn.Linear(1200, 600)
         self.fc23 = nn.Linear(600, 300)
-        self.fc3_mean = nn.Linear(300, self.EMBED_SIZE)
-        self.fc3_logvar = nn.Linear(300, self.EMBED_SIZE)
+        # Mean and log variance heads stacked into a single Linear (one GEMM instead of two)
+        self.fc3_mean_logvar = nn.Linear(300, 2 * self.EMBED_SIZE)
 
         self.fc_repr_3 = nn.Linear(self.EMBED_SIZE, 300)
         self.fc32 = nn.Linear(300, 600)
         self.fc21 = nn.Linear(600, 1200)
 
     def reparameterize(self, mu, logvar):
-        std = torch.exp(0.5 * logvar)
-        eps = torch.randn_like(std)
-        return mu + eps * std
+        return reparameterize_with_kl(mu, logvar)[0]
 
     def encode(self, x):
         h1 = self.activation(self.fc12(x))
         h2 = self.activation(self.fc23(h1))
-        return self.fc3_mean(h2), self.fc3_logvar(h2)
+        return torch.chunk(self.fc3_mean_logvar(h2), 2, dim=-1)
 
     def decode(self, z):
         h2 = self.activation(self.fc_repr_3(z))
@@ -51,8 +59,8 @@ class VAE(nn.Module):
 
     def forward(self, x):
         mu, logvar = self.encode(x)
-        z = self.reparameterize(mu, logvar)
-        return self.decode(z), mu, logvar
+        z, kdl_loss = reparameterize_with_kl(mu, logvar)
+        return self.decode(z), kdl_loss
 
     def to_string_name(self):
         return self.MODEL_NAME + '_' + str(self.MODEL_VERSION)
@@ -95,83 +103,103 @@ class AE(nn.Module):
     def to_string_name(self):
         return self.MODEL_NAME + '_' + str(self.MODEL_VERSION)
 
+# Losses are averaged over all elements of the batch (i.e., the summed loss divided by recon_x.numel())
 def loss_function_ae(recon_x, x):#, mu, logvar):
-    reconstruction_loss = F.smooth_l1_loss(recon_x, x, reduction='sum')
+    reconstruction_loss = F.smooth_l1_loss(recon_x, x, reduction='mean')
 
     return reconstruction_loss
 
-# Reconstruction + KL divergence losses summed over all elements and batch
-def loss_function_vae(recon_x, x, mu, logvar):
+# Reconstruction + KL divergence losses
+# KL divergence comes already calculated (summed) from reparameterize_with_kl()
+def loss_function_vae(recon_x, x, kdl_loss):
     #BCE = F.binary_cross_entropy(recon_x, x.view(-1, 784), reduction='sum')
-    reconstruction_loss = F.smooth_l1_loss(recon_x, x, reduction='sum')
+    reconstruction_loss = F.smooth_l1_loss(recon_x, x, reduction='mean')
 
     # see Appendix B from VAE paper:
     # Kingma and Welling. Auto-Encoding Variational Bayes. ICLR, 2014
     # https://arxiv.org/abs/1312.6114
     # 0.5 * sum(1 + log(sigma^2) - mu^2 - sigma^2)
-    kdl_loss = -0.5 * torch.sum(1 + logvar - mu.pow(2) - logvar.exp())
+    # Divided by the same number of elements as the reconstruction loss, to keep the same relative weight
+    return reconstruction_loss + kdl_loss / recon_x.numel()
 
-    return reconstruction_loss + kdl_loss
 
-
-def train_model(model, train_loader):
+def train_model(model, shuffled_indices):
     model.train()
     loss_all = 0
-
-    for data in train_loader:
-        data_ts = data.x.to(device)
-        optimizer.zero_grad()
-
-        if ENCODING_STRATEGY == EncodingStrategy.AE3layers:
-            reconstructed_batch = model(data_ts)
-            loss = loss_function_ae(reconstructed_batch, data_ts)
-        elif ENCODING_STRATEGY == EncodingStrategy.VAE3layers:
-            reconstructed_batch, mu, logvar = model(data_ts)
-            loss = loss_function_vae(reconstructed_batch, data_ts, mu, logvar)
-
-        loss.backward()
-        loss_all += loss.item()
-        optimizer.step()
-
-    # len(train_loader) gives the number of batches
-    # len(train_loader.dataset) gives the number of graphs
-    return loss_all / (len(train_loader.dataset) * NUM_NODES)
-
-
-def evaluate_model(model, loader, save_comparison=False):
+    # Graphs actually trained on (the last, partial batch is skipped with a compiled model)
+    num_graphs = 0
+
+    # Batches are just gathered from all_ts (already in the device, as the indices)
+    for start_id in range(0, len(shuffled_indices), BATCH_SIZE):
+        batch_indices = shuffled_indices[start_id:start_id + BATCH_SIZE]
+        # With a compiled model (and CUDA graphs) the shape of the training batches needs to be static
+        if COMPILE_MODEL and len(batch_indices) < BATCH_SIZE:
+            break
+        data_ts = all_ts[batch_indices].view(-1, all_ts.shape[-1])
+        optimizer.zero_grad(**kwargs_zero_grad)
+
+        with get_autocast_context(USE_AMP):
+            if ENCODING_STRATEGY == EncodingStrategy.AE3layers:
+                reconstructed_batch = model(data_ts)
+                loss = loss_function_ae(reconstructed_batch, data_ts)
+            elif ENCODING_STRATEGY == EncodingStrategy.VAE3layers:
+                reconstructed_batch, kdl_loss = model(data_ts)
+                loss = loss_function_vae(reconstructed_batch, data_ts, kdl_loss)
+
+        # Kept in the device (summed loss of the batch), to avoid a synchronisation per batch
+        loss_all += loss.detach() * data_ts.numel()
+        num_graphs += len(batch_indices)
+        if scaler is not None:
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+        else:
+            loss.backward()
+            optimizer.step()
+
+    return float(loss_all) / (num_graphs * NUM_NODES)
+
+
+def evaluate_model(model, indices, save_comparison=False):
     model.eval()
     loss_all = 0
+    if save_comparison:
+        # Reconstructions kept in the device, and then saved all at once (in the same order as indices)
+        recons_all = torch.empty((len(indices),) + all_ts.shape[1:], device=device)
 
-    for batch_id, data in enumerate(loader):
-        data_ts = data.x.to(device)
+    for start_id in range(0, len(indices), BATCH_SIZE):
+        batch_ts = all_ts[indices[start_id:start_id + BATCH_SIZE]]
+        data_ts = batch_ts.view(-1, batch_ts.shape[-1])
 
-        if ENCODING_STRATEGY == EncodingStrategy.AE3layers:
-            reconstructed_batch = model(data_ts)
-            loss = loss_function_ae(reconstructed_batch, data_ts)
-        elif ENCODING_STRATEGY == EncodingStrategy.VAE3layers:
-            reconstructed_batch, mu, logvar = model(data_ts)
-            loss = loss_function_vae(reconstructed_batch, data_ts, mu, logvar)
+        with torch.no_grad(), get_autocast_context(USE_AMP):
+            if ENCODING_STRATEGY == EncodingStrategy.AE3layers:
+                reconstructed_batch = model(data_ts)
+                loss = loss_function_ae(reconstructed_batch, data_ts)
+            elif ENCODING_STRATEGY == EncodingStrategy.VAE3layers:
+                reconstructed_batch, kdl_loss = model(data_ts)
+                loss = loss_function_vae(reconstructed_batch, data_ts, kdl_loss)
+        reconstructed_batch = reconstructed_batch.float()
 
-        loss_all += loss.item()
+        loss_all += loss.detach() * data_ts.numel()
 
         if save_comparison:
-            orig_ts, batch_bool = to_dense_batch(data_ts, data.batch.to(device))
-            recons_ts, _ = to_dense_batch(reconstructed_batch, data.batch.to(device))
-            sav_name = ENCODING_STRATEGY.value
+            # Every graph has the same number of nodes, so no need for to_dense_batch()
+            recons_all[start_id:start_id + len(batch_ts)] = reconstructed_batch.view(batch_ts.shape)
 
-            for id in range(len(batch_bool)):
-                np.save(arr=orig_ts[id].cpu().numpy(), file=f'encoder_comparisons/{sav_name}_{SPLIT_TO_TEST}_{batch_id}_{id}_orig.npy')
-                np.save(arr=recons_ts[id].detach().cpu().numpy(), file=f'encoder_comparisons/{sav_name}_{SPLIT_TO_TEST}_{batch_id}_{id}_recons.npy')
+    if save_comparison:
+        # A single file with tensors of shape (len(indices), NUM_NODES, TIME_LENGTH)
+        sav_name = ENCODING_STRATEGY.value
+        torch.save({'orig': all_ts[indices].cpu(), 'recons': recons_all.cpu()},
+                   f'encoder_comparisons/{sav_name}_{SPLIT_TO_TEST}_comparisons.pth')
 
-    # len(train_loader) gives the number of batches
-    # len(train_loader.dataset) gives the number of graphs
-    return loss_all / (len(loader.dataset) * NUM_NODES)
+    # len(indices) gives the number of graphs
+    return float(loss_all) / (len(indices) * NUM_NODES)
 
 
-def training_step(outer_split_no, inner_split_no, epoch, model, train_loader, val_loader):
-    _ = train_model(model, train_loader)
-    train_loss = evaluate_model(model, train_loader)
-    val_loss = evaluate_model(model, val_loader)
+def training_step(outer_split_no, inner_split_no, epoch, model, train_indices, val_indices):
+    # Running loss of the epoch, no need for another pass over the training set
+    train_loss = train_model(model, train_indices)
+    val_loss = evaluate_model(model, val_indices)
 
 
     print(f'{outer_split_no}-{inner_split_no}-Epoch: {epoch}, Loss: {round(train_loss, 5)} / {round(val_loss, 5)}')
@@ -181,6 +209,12 @@ def training_step(outer_split_no, inner_split_no, epoch, model, train_loader, va
 if __name__ == "__main__":
     torch.manual_seed(1)
     np.random.seed(1111)
+    # Batches always have the same shape, so the fastest algorithms are just found once
+    torch.backends.cudnn.benchmark = True
+    # TF32 tensor cores for the FP32 matmuls (only from PyTorch 1.7, Ampere onwards)
+    if hasattr(torch.backends.cuda, 'matmul'):
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
 
     parser = argparse.ArgumentParser()
 
@@ -205,10 +239,22 @@ if __name__ == "__main__":
     parser.add_argument("--normalisation", default='roi_norm')
     parser.add_argument("--time_length", type=int, default=1200)
     parser.add_argument("--encoding_strategy", default='none')
+    parser.add_argument("--compile_model", type=bool, default=False)  # to make true just include flag with 1
+    parser.add_argument("--use_amp", type=bool, default=False)  # to make true just include flag with 1
 
     args = parser.parse_args()
 
     device = torch.device(args.device)
+    # Set by torchrun when running one process per GPU, each one training its own share of the grid
+    LOCAL_RANK = int(os.environ.get('LOCAL_RANK', -1))
+    DISTRIBUTED = LOCAL_RANK != -1
+    if DISTRIBUTED:
+        # Only used to find the best model across processes (models are independent, no gradients to synchronise)
+        torch.distributed.init_process_group(backend='gloo')
+        device = torch.device(f'cuda:{LOCAL_RANK}')
+        torch.cuda.set_device(device)
+    RANK = torch.distributed.get_rank() if DISTRIBUTED else 0
+    WORLD_SIZE = torch.distributed.get_world_size() if DISTRIBUTED else 1
 
     # Making a single variable for each argument
     N_EPOCHS = args.num_epochs
@@ -229,8 +275,20 @@ if __name__ == "__main__":
     TIME_LENGTH = args.time_length
     TS_SPIT_NUM = int(4800 / TIME_LENGTH)
     ENCODING_STRATEGY = EncodingStrategy(args.encoding_strategy)
+    # torch.compile only available from PyTorch 2.0
+    COMPILE_MODEL = args.compile_model and hasattr(torch, 'compile')
+    # Mixed precision (BF16 when supported, otherwise FP16), torch.cuda.amp only available from PyTorch 1.6
+    USE_AMP = args.use_amp and device.type == 'cuda' and hasattr(torch.cuda, 'amp')
     print("Encoding strategy is:", ENCODING_STRATEGY)
 
+    if COMPILE_MODEL:
+        # So the elementwise operations and the reductions of the losses are fused
+        loss_function_ae = torch.compile(loss_function_ae)
+        loss_function_vae = torch.compile(loss_function_vae)
+    else:
+        # Otherwise the elementwise chain is fused by TorchScript (torch.compile traces it as part of the model)
+        reparameterize_with_kl = torch.jit.script(reparameterize_with_kl)
+
     name_dataset = create_name_for_brain_dataset(num_nodes=NUM_NODES,
                                                  time_length=TIME_LENGTH,
                                                  target_var=TARGET_VAR,
@@ -251,13 +309,29 @@ if __name__ == "__main__":
     N_OUT_SPLITS = 5
     N_INNER_SPLITS = 5
 
+    # The encoders only use the time series of each node, which are small enough to be kept in the device all
+    # the time (no need for DataLoaders): shape (num_graphs, NUM_NODES, TIME_LENGTH)
+    all_ts = dataset.get_stacked_features().to(device)
+
+    # Single multi-tensor kernel for the whole Adam step: fused from PyTorch 1.13 (CUDA only), foreach from 1.12
+    kwargs_adam = {}
+    if device.type == 'cuda' and 'fused' in inspect.signature(torch.optim.Adam).parameters:
+        kwargs_adam['fused'] = True
+    elif 'foreach' in inspect.signature(torch.optim.Adam).parameters:
+        kwargs_adam['foreach'] = True
+    # Gradients are just released instead of filled with zeros (only from PyTorch 1.7)
+    kwargs_zero_grad = {'set_to_none': True} if 'set_to_none' in inspect.signature(torch.optim.Optimizer.zero_grad).parameters \
+        else {}
+
     # Stratification will occur with regards to both the sex and session day
     skf = StratifiedGroupKFold(n_splits=N_OUT_SPLITS, random_state=1111)
     merged_labels = merge_y_and_others(dataset.data.y,
                                        dataset.data.index)
+    all_ys = dataset.data.y.numpy()
+    all_groups = dataset.data.hcp_id.numpy()
     skf_generator = skf.split(np.zeros((len(dataset), 1)),
                               merged_labels,
-                              groups=dataset.data.hcp_id.tolist())
+                              groups=all_groups.tolist())
 
     #
     # Main outer-loop
@@ -270,91 +344,108 @@ if __name__ == "__main__":
         if outer_split_num != SPLIT_TO_TEST:
             continue
 
-        X_train_out = dataset[torch.tensor(train_index)]
-        X_test_out = dataset[torch.tensor(test_index)]
+        train_index = np.asarray(train_index, dtype=np.int64)
+        test_index = np.asarray(test_index, dtype=np.int64)
 
-        print("Size is:", len(X_train_out), "/", len(X_test_out))
-        print("Positive classes:", sum(X_train_out.data.y.numpy()), "/", sum(X_test_out.data.y.numpy()))
+        print("Size is:", len(train_index), "/", len(test_index))
+        print("Positive classes:", sum(all_ys[train_index]), "/", sum(all_ys[test_index]))
 
-        train_out_loader = DataLoader(X_train_out, batch_size=BATCH_SIZE, shuffle=True)
-        test_out_loader = DataLoader(X_test_out, batch_size=BATCH_SIZE, shuffle=False)
+        test_out_indices = torch.from_numpy(test_index).to(device)
 
         param_grid = {'weight_decay': [0],
                       'lr': [1e-3]
                       }
 
-        grid = ParameterGrid(param_grid)
+        # Inner split does not depend on the hyperparameters, so it is only calculated once for the whole grid
+        skf_inner = StratifiedGroupKFold(n_splits=N_INNER_SPLITS, random_state=1111)
+        # Labels are sliced from the ones already merged (and re-encoded, as some labels might not be in this fold)
+        merged_labels_inner = np.unique(merged_labels[train_index], return_inverse=True)[1]
+        skf_inner_generator = skf_inner.split(np.zeros((len(train_index), 1)),
+                                              merged_labels_inner,
+                                              groups=all_groups[train_index].tolist())
+        # Only the first inner split is used (for now)
+        inner_train_index, inner_val_index = next(skf_inner_generator)
+
+        # Indices of all_ts
+        train_in_indices = torch.from_numpy(train_index[inner_train_index]).to(device)
+        val_indices = torch.from_numpy(train_index[inner_val_index]).to(device)
+        # Shuffles of all epochs generated at once in the device (one random permutation per row)
+        epoch_permutations = torch.rand(N_EPOCHS, len(train_in_indices), device=device).argsort(dim=1)
+
+        grid = list(ParameterGrid(param_grid))
         best_model_name_outer_fold_loss = None
         best_outer_metric_loss = 1000
-        for params in grid:
+        # Only one inner split is used, so the work items are just the grid points, split across processes
+        for params in grid[RANK::WORLD_SIZE]:
             print("For ", params)
 
-            skf_inner = StratifiedGroupKFold(n_splits=N_INNER_SPLITS, random_state=1111)
-            merged_labels_inner = merge_y_and_others(X_train_out.data.y,
-                                                     X_train_out.data.index)
-            skf_inner_generator = skf_inner.split(np.zeros((len(X_train_out), 1)),
-                                                  merged_labels_inner,
-                                                  groups=X_train_out.data.hcp_id.tolist())
-            model_with_sigmoid = True
-
-            # This for-cycle will only be executed once (for now)
-            for inner_train_index, inner_val_index in skf_inner_generator:
-
-                if ENCODING_STRATEGY == EncodingStrategy.AE3layers:
-                    model = AE().to(device)
-                elif ENCODING_STRATEGY == EncodingStrategy.VAE3layers:
-                    model = VAE().to(device)
-                trainable_params = sum(p.numel() for p in model.parameters() if p.requires_grad)
-                print("Number of trainable params:", trainable_params)
-
-                X_train_in = X_train_out[torch.tensor(inner_train_index)]
-                X_val_in = X_train_out[torch.tensor(inner_val_index)]
-
-                train_in_loader = DataLoader(X_train_in, batch_size=BATCH_SIZE, shuffle=True)
-                val_loader = DataLoader(X_val_in, batch_size=BATCH_SIZE, shuffle=False)
-
-                optimizer = torch.optim.Adam(model.parameters(),
-                                             lr=params['lr'],
-                                             weight_decay=params['weight_decay'])
-
-                inner_model_name = create_name_for_encoder_model(ts_length=TIME_LENGTH,
-                                                           outer_split_num=outer_split_num,
-                                                           encoder_name=model.to_string_name(),
-                                                           params=params)
-                loss_history_path = create_name_for_encoder_model(ts_length=TIME_LENGTH,
-                                                                  outer_split_num=outer_split_num,
-                                                                  encoder_name=model.to_string_name(),
-                                                                  params=params,
-                                                                  suffix='')
-
-                best_metrics_fold_loss = 1000
-                losses = {'train' : [],
-                          'val': []}
-                for epoch in range(N_EPOCHS):
-                    train_loss, val_loss = training_step(outer_split_num,
-                                                  0,
-                                                  epoch,
-                                                  model,
-                                                  train_in_loader,
-                                                  val_loader)
-                    losses['train'].append(train_loss)
-                    losses['val'].append(val_loss)
-
-                    if val_loss < best_metrics_fold_loss:
-                        best_metrics_fold_loss = val_loss
-                        torch.save(model, inner_model_name)
-                        if val_loss < best_outer_metric_loss:
-                            best_outer_metric_loss = val_loss
-                            best_model_name_outer_fold_loss = inner_model_name
-                np.save(arr=np.array(losses['train']), file=loss_history_path + '_train.npy')
-                np.save(arr=np.array(losses['val']), file=loss_history_path + '_val.npy')
-                break
+            if ENCODING_STRATEGY == EncodingStrategy.AE3layers:
+                model = AE().to(device)
+            elif ENCODING_STRATEGY == EncodingStrategy.VAE3layers:
+                model = VAE().to(device)
+            trainable_params = sum(p.numel() for p in model.parameters() if p.requires_grad)
+            print("Number of trainable params:", trainable_params)
+            # Original model is kept for saving, as torch.save() cannot pickle a compiled model
+            train_model_fn = model
+            if COMPILE_MODEL:
+                # Small Linear+Tanh layers are dominated by kernel launches and activation round-trips: max-autotune
+                # uses CUDA graphs (as reduce-overhead) and Triton matmuls with the bias and Tanh fused as epilogues
+                train_model_fn = torch.compile(model, mode='max-autotune', fullgraph=True)
+
+            optimizer = torch.optim.Adam(model.parameters(),
+                                         lr=params['lr'],
+                                         weight_decay=params['weight_decay'],
+                                         **kwargs_adam)
+            scaler = get_grad_scaler(USE_AMP) if USE_AMP else None
+
+            inner_model_name = create_name_for_encoder_model(ts_length=TIME_LENGTH,
+                                                       outer_split_num=outer_split_num,
+                                                       encoder_name=model.to_string_name(),
+                                                       params=params)
+            loss_history_path = create_name_for_encoder_model(ts_length=TIME_LENGTH,
+                                                              outer_split_num=outer_split_num,
+                                                              encoder_name=model.to_string_name(),
+                                                              params=params,
+                                                              suffix='')
+
+            best_metrics_fold_loss = 1000
+            losses = {'train' : [],
+                      'val': []}
+            for epoch in range(N_EPOCHS):
+                train_loss, val_loss = training_step(outer_split_num,
+                                              0,
+                                              epoch,
+                                              train_model_fn,
+                                              train_in_indices[epoch_permutations[epoch]],
+                                              val_indices)
+                losses['train'].append(train_loss)
+                losses['val'].append(val_loss)
+
+                if val_loss < best_metrics_fold_loss:
+                    best_metrics_fold_loss = val_loss
+                    torch.save(model, inner_model_name)
+                    if val_loss < best_outer_metric_loss:
+                        best_outer_metric_loss = val_loss
+                        best_model_name_outer_fold_loss = inner_model_name
+            np.save(arr=np.array(losses['train']), file=loss_history_path + '_train.npy')
+            np.save(arr=np.array(losses['val']), file=loss_history_path + '_val.npy')
+
+        if DISTRIBUTED:
+            best_loss_per_rank = torch.zeros(WORLD_SIZE)
+            best_loss_per_rank[RANK] = best_outer_metric_loss
+            torch.distributed.all_reduce(best_loss_per_rank)
+            # Only the process with the best model overall evaluates (and saves) it
+            if int(torch.argmin(best_loss_per_rank)) != RANK:
+                continue
 
         model = torch.load(best_model_name_outer_fold_loss)
-        test_loss = evaluate_model(model, test_out_loader, save_comparison=True)
+        test_loss = evaluate_model(model, test_out_indices, save_comparison=True)
         print('Best params: ', best_model_name_outer_fold_loss, '(', best_outer_metric_loss, ')')
         print(f'{outer_split_num}--Final Loss: {round(test_loss, 5)}')
 
         torch.save(model, create_best_encoder_name(ts_length=TIME_LENGTH,
                                                    outer_split_num=outer_split_num,
                                                    encoder_name=model.MODEL_NAME))
+
+    if DISTRIBUTED:
+        torch.distributed.destroy_process_group()
@@ -1,10 +1,11 @@
-import numpy as np
 import matplotlib.pyplot as plt
+import torch
 
 for person in [30, 60]:
     for sav_name in ['3layerAE', '3layerVAE']:
-        orig_ts = np.load(f'encoder_comparisons/{sav_name}_1_0_{person}_orig.npy')
-        recons_ts = np.load(f'encoder_comparisons/{sav_name}_1_0_{person}_recons.npy')
+        comparisons = torch.load(f'encoder_comparisons/{sav_name}_1_comparisons.pth')
+        orig_ts = comparisons['orig'][person].numpy()
+        recons_ts = comparisons['recons'][person].numpy()
         for i in range(50):
             fig, ax = plt.subplots(nrows=2, ncols=1)
 
@@ -1,26 +1,37 @@
+import gc
+import inspect
 import os
+import os.path as osp
 import pickle
 import random
-from collections import deque
+from contextlib import nullcontext
 from sys import exit
-from typing import Dict, Any, Union
+from typing import Dict, Any, Union, Tuple, List
 
 import numpy as np
 import pandas as pd
 import torch
 import wandb
 from scipy.stats import stats
-from sklearn.metrics import roc_auc_score, accuracy_score, f1_score, classification_report, r2_score
+from sklearn.metrics import roc_auc_score, confusion_matrix, r2_score
 from sklearn.model_selection import StratifiedKFold
 from sklearn.preprocessing import LabelEncoder, MinMaxScaler
-from torch_geometric.data import DataLoader
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data.distributed import DistributedSampler
+from torch_geometric.data import Data
 from xgboost import XGBClassifier, XGBRegressor, XGBModel
 
-from datasets import BrainDataset, HCPDataset, UKBDataset, FlattenCorrsDataset
+from datasets import BrainDataset, HCPDataset, UKBDataset, FlattenCorrsDataset, BrainDataLoader
 from model import SpatioTemporalModel
 from utils import create_name_for_brain_dataset, create_name_for_model, Normalisation, ConnType, ConvStrategy, \
     StratifiedGroupKFold, PoolingStrategy, AnalysisType, merge_y_and_others, EncodingStrategy, create_best_encoder_name, \
-    SweepType, DatasetType, get_freer_gpu, free_gpu_info, create_name_for_flattencorrs_dataset, create_name_for_xgbmodel
+    SweepType, DatasetType, get_freer_gpu, free_gpu_info, create_name_for_flattencorrs_dataset, create_name_for_xgbmodel, \
+    is_main_process, FoldSampler, get_autocast_context, get_grad_scaler, WandbConfigDict
+
+# Both are part of the cached splits' file names: FOLD_SPLITS_VERSION needs to be increased whenever the way the folds
+# are created changes, so that old caches are not picked up
+FOLD_SPLITS_RANDOM_STATE: int = 1111
+FOLD_SPLITS_VERSION: int = 1
 
 
 class MSLELoss(torch.nn.Module):
@@ -43,50 +54,95 @@ class MSLELoss(torch.nn.Module):
         return loss.mean()
 
 
-def train_model(model, train_loader, optimizer, pooling_mechanism, device, label_scaler=None):
+def get_criterion(model, label_scaler=None) -> torch.nn.Module:
+    if label_scaler is not None:
+        return torch.nn.SmoothL1Loss()
+    # Without the final sigmoid the model outputs logits, so sigmoid+BCE can be fused in a single, more stable, op
+    if getattr(model, 'module', model).final_sigmoid:
+        return torch.nn.BCELoss()
+    return torch.nn.BCEWithLogitsLoss()
+
+
+def train_model(model, train_loader, optimizer, pooling_mechanism, device, label_scaler=None, accum_steps=1,
+                use_amp=False, scaler=None):
     model.train()
     loss_all = 0
     loss_all_link = 0
     loss_all_ent = 0
-    if label_scaler is None:
-        criterion = torch.nn.BCELoss()
-    else:
-        criterion = torch.nn.SmoothL1Loss()
-
-    grads = {'final_l': [],
-             'conv1d_1': []
-             }
-    for data in train_loader:
-        data = data.to(device)
-        optimizer.zero_grad()
-        if pooling_mechanism == PoolingStrategy.DIFFPOOL:
-            output_batch, link_loss, ent_loss = model(data)
-            loss = criterion(output_batch, data.y.unsqueeze(1)) + link_loss + ent_loss
-            loss_b_link = link_loss
-            loss_b_ent = ent_loss
+    criterion = get_criterion(model, label_scaler)
+
+    # Summary statistics of the final layer's gradients, accumulated in the device to avoid a sync per batch
+    grad_sum = 0
+    grad_sq_sum = 0
+    grad_max = None
+    grad_num = 0
+    # Gradients are just released instead of filled with zeros (only from PyTorch 1.7)
+    kwargs_zero_grad = {'set_to_none': True} if 'set_to_none' in inspect.signature(optimizer.zero_grad).parameters \
+        else {}
+    optimizer.zero_grad(**kwargs_zero_grad)
+    for batch_id, data in enumerate(train_loader):
+        # Asynchronous copy (from pinned memory), overlapping with the previous iteration's computation
+        data = data.apply(lambda x: x.to(device, non_blocking=True))
+        # Gradients are accumulated over accum_steps batches before each optimizer step
+        is_accum_step = (batch_id + 1) % accum_steps != 0 and (batch_id + 1) != len(train_loader)
+        # No need to all-reduce gradients in DistributedDataParallel until the actual optimizer step
+        if is_accum_step and isinstance(model, DistributedDataParallel):
+            sync_context = model.no_sync()
         else:
-            output_batch = model(data)
-            loss = criterion(output_batch, data.y.unsqueeze(1))
+            sync_context = nullcontext()
 
-        loss.backward()
+        with sync_context:
+            # Only the forward pass is autocast, losses are always calculated in FP32
+            if pooling_mechanism == PoolingStrategy.DIFFPOOL:
+                with get_autocast_context(use_amp):
+                    output_batch, link_loss, ent_loss = model(data)
+                loss = criterion(output_batch.float(), data.y.unsqueeze(1)) + link_loss.float() + ent_loss.float()
+                loss_b_link = link_loss
+                loss_b_ent = ent_loss
+            else:
+                with get_autocast_context(use_amp):
+                    output_batch = model(data)
+                loss = criterion(output_batch.float(), data.y.unsqueeze(1))
 
-        grads['final_l'].extend(model.final_linear.weight.grad.flatten().cpu().tolist())
-        grads['conv1d_1'].extend(model.final_linear.weight.grad.flatten().cpu().tolist())
+            if scaler is not None:
+                scaler.scale(loss / accum_steps).backward()
+            else:
+                (loss / accum_steps).backward()
 
         loss_all += loss.item() * data.num_graphs
         if pooling_mechanism == PoolingStrategy.DIFFPOOL:
             loss_all_link += loss_b_link.item() * data.num_graphs
             loss_all_ent += loss_b_ent.item() * data.num_graphs
 
-        torch.nn.utils.clip_grad_value_(model.parameters(), 1)
-        optimizer.step()
-    print("GRAD", np.mean(grads['final_l']), np.max(grads['final_l']), np.std(grads['final_l']))
+        if not is_accum_step:
+            if scaler is not None:
+                # Both the gradient statistics and the clipping need the actual gradient values
+                scaler.unscale_(optimizer)
+
+            # Only the fully accumulated gradients (i.e., the ones used in the optimizer step) are tracked, before
+            # clipping. DistributedDataParallel keeps the actual model in .module
+            final_l_grad = getattr(model, 'module', model).final_linear.weight.grad.detach()
+            grad_sum += final_l_grad.sum()
+            grad_sq_sum += (final_l_grad * final_l_grad).sum()
+            grad_max = final_l_grad.max() if grad_max is None else torch.max(grad_max, final_l_grad.max())
+            grad_num += final_l_grad.numel()
+
+            torch.nn.utils.clip_grad_value_(model.parameters(), 1)
+            if scaler is not None:
+                scaler.step(optimizer)
+                scaler.update()
+            else:
+                optimizer.step()
+            optimizer.zero_grad(**kwargs_zero_grad)
+    grad_mean = float(grad_sum) / grad_num
+    grad_std = np.sqrt(max(float(grad_sq_sum) / grad_num - grad_mean ** 2, 0))
+    print("GRAD", grad_mean, float(grad_max), grad_std)
     # len(train_loader) gives the number of batches
-    # len(train_loader.dataset) gives the number of graphs
+    # len(train_loader.sampler) gives the number of graphs (only this process' shard when distributed)
 
     # Returning a weighted average according to number of graphs
-    return loss_all / len(train_loader.dataset), loss_all_link / len(train_loader.dataset), loss_all_ent / len(
-        train_loader.dataset)
+    return loss_all / len(train_loader.sampler), loss_all_link / len(train_loader.sampler), loss_all_ent / len(
+        train_loader.sampler)
 
 
 def return_regressor_metrics(labels, pred_prob, label_scaler=None, loss_value=None, link_loss_value=None,
@@ -108,19 +164,16 @@ def return_regressor_metrics(labels, pred_prob, label_scaler=None, loss_value=No
 
 
 def return_classifier_metrics(labels, pred_binary, pred_prob, loss_value=None, link_loss_value=None,
-                              ent_loss_value=None,
-                              flatten_approach: bool = False):
+                              ent_loss_value=None):
     roc_auc = roc_auc_score(labels, pred_prob)
-    acc = accuracy_score(labels, pred_binary)
-    f1 = f1_score(labels, pred_binary, zero_division=0)
-    report = classification_report(labels, pred_binary, output_dict=True, zero_division=0)
+    # All the other metrics come from a single pass over the labels (the confusion matrix)
+    tn, fp, fn, tp = confusion_matrix(labels, pred_binary, labels=[0, 1]).ravel()
 
-    if not flatten_approach:
-        sens = report['1.0']['recall']
-        spec = report['0.0']['recall']
-    else:
-        sens = report['1']['recall']
-        spec = report['0']['recall']
+    # Same as sklearn's zero_division=0
+    acc = (tp + tn) / (tn + fp + fn + tp)
+    f1 = 2 * tp / (2 * tp + fp + fn) if tp + fp + fn > 0 else 0.0
+    sens = tp / (tp + fn) if tp + fn > 0 else 0.0
+    spec = tn / (tn + fp) if tn + fp > 0 else 0.0
 
     return {'loss': loss_value,
             'link_loss': link_loss_value,
@@ -133,66 +186,76 @@ def return_classifier_metrics(labels, pred_binary, pred_prob, loss_value=None, l
             }
 
 
-def evaluate_model(model, loader, pooling_mechanism, device, label_scaler=None):
+def evaluate_model(model, loader, pooling_mechanism, device, label_scaler=None, use_amp=False):
     model.eval()
-    if label_scaler is None:
-        criterion = torch.nn.BCELoss()
-    else:
-        criterion = torch.nn.SmoothL1Loss()
+    criterion = get_criterion(model, label_scaler)
 
-    predictions = []
-    labels = []
+    # Pre-sized buffers in the device, filled in place batch after batch
+    predictions = torch.empty(len(loader.sampler), device=device)
+    labels = torch.empty(len(loader.sampler), device=device)
+    num_graphs = 0
     test_error = 0
     test_link_loss = 0
     test_ent_loss = 0
 
     for data in loader:
         with torch.no_grad():
-            data = data.to(device)
+            data = data.apply(lambda x: x.to(device, non_blocking=True))
             if pooling_mechanism == PoolingStrategy.DIFFPOOL:
-                output_batch, link_loss, ent_loss = model(data)
+                with get_autocast_context(use_amp):
+                    output_batch, link_loss, ent_loss = model(data)
+                output_batch = output_batch.float()
                 # output_batch = output_batch.flatten()
-                loss = criterion(output_batch, data.y.unsqueeze(1)) + link_loss + ent_loss
+                loss = criterion(output_batch, data.y.unsqueeze(1)) + link_loss.float() + ent_loss.float()
                 loss_b_link = link_loss
                 loss_b_ent = ent_loss
             else:
-                output_batch = model(data)
+                with get_autocast_context(use_amp):
+                    output_batch = model(data)
+                output_batch = output_batch.float()
                 # output_batch = output_batch.flatten()
                 loss = criterion(output_batch, data.y.unsqueeze(1))
 
-            test_error += loss.item() * data.num_graphs
+            # Everything stays in the device until the end, to avoid a synchronous copy per batch
+            test_error += loss.detach() * data.num_graphs
             if pooling_mechanism == PoolingStrategy.DIFFPOOL:
-                test_link_loss += loss_b_link.item() * data.num_graphs
-                test_ent_loss += loss_b_ent.item() * data.num_graphs
-
-            pred = output_batch.flatten().detach().cpu().numpy()
-
-            label = data.y.detach().cpu().numpy()
-            predictions.append(pred)
-            labels.append(label)
-    predictions = np.hstack(predictions)
-    labels = np.hstack(labels)
+                test_link_loss += loss_b_link.detach() * data.num_graphs
+                test_ent_loss += loss_b_ent.detach() * data.num_graphs
+
+            predictions[num_graphs:num_graphs + data.num_graphs] = output_batch.flatten().detach()
+            labels[num_graphs:num_graphs + data.num_graphs] = data.y.detach()
+            num_graphs += data.num_graphs
+    # Loader might drop the last batch, so buffers are not necessarily all filled
+    predictions = predictions[:num_graphs]
+    if label_scaler is None and not getattr(model, 'module', model).final_sigmoid:
+        predictions = torch.sigmoid(predictions)
+    labels = labels[:num_graphs].cpu().numpy()
 
     if label_scaler is None:
-        pred_binary = np.where(predictions > 0.5, 1, 0)
-        return return_classifier_metrics(labels, pred_binary, predictions,
-                                         loss_value=test_error / len(loader.dataset),
-                                         link_loss_value=test_link_loss / len(loader.dataset),
-                                         ent_loss_value=test_ent_loss / len(loader.dataset))
+        pred_binary = (predictions > 0.5).long().cpu().numpy()
+        return return_classifier_metrics(labels, pred_binary, predictions.cpu().numpy(),
+                                         loss_value=float(test_error) / num_graphs,
+                                         link_loss_value=float(test_link_loss) / num_graphs,
+                                         ent_loss_value=float(test_ent_loss) / num_graphs)
     else:
-        return return_regressor_metrics(labels, predictions,
+        return return_regressor_metrics(labels, predictions.cpu().numpy(),
                                         label_scaler=label_scaler,
-                                        loss_value=test_error / len(loader.dataset),
-                                        link_loss_value=test_link_loss / len(loader.dataset),
-                                        ent_loss_value=test_ent_loss / len(loader.dataset))
+                                        loss_value=float(test_error) / num_graphs,
+                                        link_loss_value=float(test_link_loss) / num_graphs,
+                                        ent_loss_value=float(test_ent_loss) / num_graphs)
 
 
 def training_step(outer_split_no, inner_split_no, epoch, model, train_loader, val_loader, optimizer,
-                  pooling_mechanism, device, label_scaler=None):
+                  pooling_mechanism, device, label_scaler=None, accum_steps=1, use_amp=False, scaler=None):
     loss, link_loss, ent_loss = train_model(model, train_loader, optimizer, pooling_mechanism, device,
-                                            label_scaler=label_scaler)
-    train_metrics = evaluate_model(model, train_loader, pooling_mechanism, device, label_scaler=label_scaler)
-    val_metrics = evaluate_model(model, val_loader, pooling_mechanism, device, label_scaler=label_scaler)
+                                            label_scaler=label_scaler, accum_steps=accum_steps,
+                                            use_amp=use_amp, scaler=scaler)
+    train_metrics = evaluate_model(model, train_loader, pooling_mechanism, device, label_scaler=label_scaler,
+                                   use_amp=use_amp)
+    val_metrics = evaluate_model(model, val_loader, pooling_mechanism, device, label_scaler=label_scaler,
+                                 use_amp=use_amp)
+    # With DistributedSampler, rank 0 only evaluates its own shard of the training set, so they are logged as such
+    train_key = 'train_rank0' if isinstance(train_loader.sampler, DistributedSampler) else 'train'
 
     if label_scaler is None:
         print(
@@ -201,80 +264,124 @@ def training_step(outer_split_no, inner_split_no, epoch, model, train_loader, va
                               train_metrics['auc'], val_metrics['auc'],
                               train_metrics['acc'], val_metrics['acc'],
                               train_metrics['f1'], val_metrics['f1']))
-        wandb.log({
-            f'train_loss{inner_split_no}': train_metrics['loss'], f'val_loss{inner_split_no}': val_metrics['loss'],
-            f'train_auc{inner_split_no}': train_metrics['auc'], f'val_auc{inner_split_no}': val_metrics['auc'],
-            f'train_acc{inner_split_no}': train_metrics['acc'], f'val_acc{inner_split_no}': val_metrics['acc'],
-            f'train_sens{inner_split_no}': train_metrics['sensitivity'],
-            f'val_sens{inner_split_no}': val_metrics['sensitivity'],
-            f'train_spec{inner_split_no}': train_metrics['specificity'],
-            f'val_spec{inner_split_no}': val_metrics['specificity'],
-            f'train_f1{inner_split_no}': train_metrics['f1'], f'val_f1{inner_split_no}': val_metrics['f1']
-        })
+        if is_main_process():
+            wandb.log({
+                f'{train_key}_loss{inner_split_no}': train_metrics['loss'],
+                f'val_loss{inner_split_no}': val_metrics['loss'],
+                f'{train_key}_auc{inner_split_no}': train_metrics['auc'], f'val_auc{inner_split_no}': val_metrics['auc'],
+                f'{train_key}_acc{inner_split_no}': train_metrics['acc'], f'val_acc{inner_split_no}': val_metrics['acc'],
+                f'{train_key}_sens{inner_split_no}': train_metrics['sensitivity'],
+                f'val_sens{inner_split_no}': val_metrics['sensitivity'],
+                f'{train_key}_spec{inner_split_no}': train_metrics['specificity'],
+                f'val_spec{inner_split_no}': val_metrics['specificity'],
+                f'{train_key}_f1{inner_split_no}': train_metrics['f1'], f'val_f1{inner_split_no}': val_metrics['f1']
+            })
     else:
         print(
             '{:1d}-{:1d}-Epoch: {:03d}, Loss: {:.7f} / {:.7f}, R2: {:.4f} / {:.4f}, R: {:.4f} / {:.4f}'
             ''.format(outer_split_no, inner_split_no, epoch, train_metrics['loss'], val_metrics['loss'],
                       train_metrics['r2'], val_metrics['r2'],
                       train_metrics['r'], val_metrics['r']))
+        if is_main_process():
+            wandb.log({
+                f'{train_key}_loss{inner_split_no}': train_metrics['loss'],
+                f'val_loss{inner_split_no}': val_metrics['loss'],
+                f'{train_key}_r2{inner_split_no}': train_metrics['r2'], f'val_r2{inner_split_no}': val_metrics['r2'],
+                f'{train_key}_r{inner_split_no}': train_metrics['r'], f'val_r{inner_split_no}': val_metrics['r']
+            })
+
+    if pooling_mechanism == PoolingStrategy.DIFFPOOL and is_main_process():
         wandb.log({
-            f'train_loss{inner_split_no}': train_metrics['loss'], f'val_loss{inner_split_no}': val_metrics['loss'],
-            f'train_r2{inner_split_no}': train_metrics['r2'], f'val_r2{inner_split_no}': val_metrics['r2'],
-            f'train_r{inner_split_no}': train_metrics['r'], f'val_r{inner_split_no}': val_metrics['r']
-        })
-
-    if pooling_mechanism == PoolingStrategy.DIFFPOOL:
-        wandb.log({
-            f'train_link_loss{inner_split_no}': link_loss, f'val_link_loss{inner_split_no}': val_metrics['link_loss'],
-            f'train_ent_loss{inner_split_no}': ent_loss, f'val_ent_loss{inner_split_no}': val_metrics['ent_loss']
+            f'{train_key}_link_loss{inner_split_no}': link_loss, f'val_link_loss{inner_split_no}': val_metrics['link_loss'],
+            f'{train_key}_ent_loss{inner_split_no}': ent_loss, f'val_ent_loss{inner_split_no}': val_metrics['ent_loss']
         })
 
     return val_metrics
 
 
-def create_fold_generator(dataset: BrainDataset, run_cfg: Dict[str, Any], num_splits: int):
+def get_data_attributes(dataset) -> Dict[str, np.ndarray]:
+    """
+    Goes through the dataset only once to cache the scalar attributes of each graph (used for stratification and
+    logging), so that each fold can just slice these arrays instead of iterating over all the Data objects again.
+    """
+    attr_lists: Dict[str, list] = {}
+    for data_id, data in enumerate(dataset):
+        if data_id == 0:
+            # Attributes present (which depend on the dataset type) are decided from the first graph only
+            attr_lists = {key: [] for key in ['y', 'index', 'hcp_id', 'sex', 'age', 'bmi'] if data[key] is not None}
+        for key, values in attr_lists.items():
+            # Otherwise the arrays would no longer be aligned with the dataset's indices
+            if data[key] is None:
+                raise ValueError(f'Graph {data_id} of the dataset has no "{key}", unlike the first one')
+            values.append(data[key].item())
+
+    return {key: np.array(values) for key, values in attr_lists.items()}
+
+
+def slice_data_attributes(data_attrs: Dict[str, np.ndarray], indices) -> Dict[str, np.ndarray]:
+    return {key: values[indices] for key, values in data_attrs.items()}
+
+
+def create_fold_generator(dataset: Union[BrainDataset, List[Data]], run_cfg: Dict[str, Any], num_splits: int,
+                          data_attrs: Dict[str, np.ndarray] = None):
+    if data_attrs is None:
+        data_attrs = get_data_attributes(dataset)
+
     if run_cfg['dataset_type'] == DatasetType.HCP:
         # Stratification will occur with regards to both the sex and session day
-        skf = StratifiedGroupKFold(n_splits=num_splits, random_state=1111)
-        merged_labels = merge_y_and_others(torch.cat([data.y for data in dataset], dim=0),
-                                           torch.cat([data.index for data in dataset], dim=0))
+        skf = StratifiedGroupKFold(n_splits=num_splits, random_state=FOLD_SPLITS_RANDOM_STATE)
+        merged_labels = merge_y_and_others(torch.from_numpy(data_attrs['y']),
+                                           torch.from_numpy(data_attrs['index']))
         skf_generator = skf.split(np.zeros((len(dataset), 1)),
                                   merged_labels,
-                                  groups=[data.hcp_id.item() for data in dataset])
+                                  groups=data_attrs['hcp_id'].tolist())
     else:
         # UKB stratification over sex, age, and BMI (needs discretisation first)
-        sexes = []
-        bmis = []
-        ages = []
-        for data in dataset:
-            if run_cfg['analysis_type'] == AnalysisType.FLATTEN_CORRS:
-                sexes.append(data.sex.item())
-                ages.append(data.age.item())
-                bmis.append(data.bmi.item())
-            elif run_cfg['target_var'] == 'gender':
-                sexes.append(data.y.item())
-                ages.append(data.age.item())
-                bmis.append(data.bmi.item())
-            elif run_cfg['target_var'] == 'age':
-                sexes.append(data.sex.item())
-                ages.append(data.y.item())
-                bmis.append(data.bmi.item())
-            elif run_cfg['target_var'] == 'bmi':
-                sexes.append(data.sex.item())
-                ages.append(data.age.item())
-                bmis.append(data.y.item())
+        if run_cfg['analysis_type'] == AnalysisType.FLATTEN_CORRS:
+            sexes, ages, bmis = data_attrs['sex'], data_attrs['age'], data_attrs['bmi']
+        elif run_cfg['target_var'] == 'gender':
+            sexes, ages, bmis = data_attrs['y'], data_attrs['age'], data_attrs['bmi']
+        elif run_cfg['target_var'] == 'age':
+            sexes, ages, bmis = data_attrs['sex'], data_attrs['y'], data_attrs['bmi']
+        elif run_cfg['target_var'] == 'bmi':
+            sexes, ages, bmis = data_attrs['sex'], data_attrs['age'], data_attrs['y']
         bmis = pd.qcut(bmis, 7, labels=False)
         bmis[np.isnan(bmis)] = 7
         ages = pd.qcut(ages, 7, labels=False)
         strat_labels = LabelEncoder().fit_transform([f'{sexes[i]}{ages[i]}{bmis[i]}' for i in range(len(dataset))])
 
-        skf = StratifiedKFold(n_splits=num_splits, shuffle=True, random_state=1111)
+        skf = StratifiedKFold(n_splits=num_splits, shuffle=True, random_state=FOLD_SPLITS_RANDOM_STATE)
         skf_generator = skf.split(np.zeros((len(dataset), 1)),
                                   strat_labels)
 
     return skf_generator
 
 
+def get_fold_splits(dataset: Union[BrainDataset, FlattenCorrsDataset, List[Data]], run_cfg: Dict[str, Any],
+                    num_splits: int, data_attrs: Dict[str, np.ndarray],
+                    cache_dir: str, cache_name: str) -> List[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Splits are deterministic (random_state=FOLD_SPLITS_RANDOM_STATE), so they are only calculated once and then cached
+    to disk, next to the processed dataset.
+    """
+    cache_path = osp.join(cache_dir, f'{cache_name}_rs{FOLD_SPLITS_RANDOM_STATE}_v{FOLD_SPLITS_VERSION}.pkl')
+    if osp.exists(cache_path):
+        with open(cache_path, 'rb') as fd:
+            return pickle.load(fd)
+
+    # Stored as contiguous int64, so they can be used as they are to index arrays (or wrapped with torch.from_numpy)
+    splits = [(np.ascontiguousarray(train_index, dtype=np.int64), np.ascontiguousarray(test_index, dtype=np.int64))
+              for train_index, test_index in create_fold_generator(dataset, run_cfg, num_splits, data_attrs=data_attrs)]
+    if is_main_process():
+        # Written to a temporary file first, so another run never loads a half-written cache
+        tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as fd:
+            pickle.dump(splits, fd)
+        os.replace(tmp_path, cache_path)
+
+    return splits
+
+
 def generate_dataset(run_cfg: Dict[str, Any]) -> Union[BrainDataset, FlattenCorrsDataset]:
     if run_cfg['analysis_type'] == AnalysisType.FLATTEN_CORRS:
         name_dataset = create_name_for_flattencorrs_dataset(run_cfg)
@@ -313,6 +420,14 @@ def generate_dataset(run_cfg: Dict[str, Any]) -> Union[BrainDataset, FlattenCorr
 
 
 def generate_xgb_model(run_cfg: Dict[str, Any]) -> XGBModel:
+    device_run: str = run_cfg.get('device_run', 'cpu')
+    if device_run.startswith('cuda'):
+        # Histogram construction is memory-bandwidth bound, so it is much faster in the GPU
+        device_kwargs = {'tree_method': 'gpu_hist', 'predictor': 'gpu_predictor',
+                         'gpu_id': int(device_run.split(':')[1]), 'n_jobs': 1}
+    else:
+        device_kwargs = {'n_jobs': -1}
+
     if run_cfg['target_var'] == 'gender':
         model = XGBClassifier(subsample=run_cfg['subsample'],
                               learning_rate=run_cfg['learning_rate'],
@@ -323,8 +438,8 @@ def generate_xgb_model(run_cfg: Dict[str, Any]) -> XGBModel:
                               colsample_bylevel=run_cfg['colsample_bylevel'],
                               n_estimators=run_cfg['n_estimators'],
                               gamma=run_cfg['gamma'],
-                              n_jobs=-1,
-                              random_state=1111)
+                              random_state=1111,
+                              **device_kwargs)
     else:
         model = XGBRegressor(subsample=run_cfg['subsample'],
                              learning_rate=run_cfg['learning_rate'],
@@ -335,8 +450,8 @@ def generate_xgb_model(run_cfg: Dict[str, Any]) -> XGBModel:
                              colsample_bylevel=run_cfg['colsample_bylevel'],
                              n_estimators=run_cfg['n_estimators'],
                              gamma=run_cfg['gamma'],
-                             n_jobs=-1,
-                             random_state=1111)
+                             random_state=1111,
+                             **device_kwargs)
     return model
 
 
@@ -350,7 +465,8 @@ def generate_st_model(run_cfg: Dict[str, Any], for_test: bool = False) -> Spatio
             pass  # from encoders import VAE  # Necessary to torch.load
         encoding_model = torch.load(create_best_encoder_name(ts_length=run_cfg['time_length'],
                                                              outer_split_num=outer_split_num,
-                                                             encoder_name=run_cfg['param_encoding_strategy'].value))
+                                                             encoder_name=run_cfg['param_encoding_strategy'].value),
+                                    map_location=run_cfg['device_run'])
 
     model = SpatioTemporalModel(num_time_length=run_cfg['time_length'],
                                 dropout_perc=run_cfg['param_dropout'],
@@ -370,7 +486,7 @@ def generate_st_model(run_cfg: Dict[str, Any], for_test: bool = False) -> Spatio
                                 temporal_embed_size=run_cfg['temporal_embed_size']
                                 ).to(run_cfg['device_run'])
 
-    if not for_test:
+    if not for_test and is_main_process():
         wandb.watch(model, log='all')
         trainable_params = sum(p.numel() for p in model.parameters() if p.requires_grad)
         print("Number of trainable params:", trainable_params)
@@ -379,38 +495,45 @@ def generate_st_model(run_cfg: Dict[str, Any], for_test: bool = False) -> Spatio
     return model
 
 
+def get_array_data(dataset: FlattenCorrsDataset, data_attrs: Dict[str, np.ndarray],
+                   run_cfg: Dict[str, Any]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Dense (N, F) matrix with the flatten correlations of the whole dataset, together with the target labels, so that
+    each fold is just a fancy-index gather on these arrays.
+    """
+    # dataset.data holds all the graphs collated, with each x (of size F) concatenated one after another
+    flatten_arr = dataset.data.x.view(len(dataset), -1).numpy()
+
+    if run_cfg['target_var'] == 'gender':
+        y_arr = data_attrs['sex'].astype(int)
+    elif run_cfg['target_var'] == 'age':
+        # np.array because of printing calls in the regressor_metrics function
+        y_arr = data_attrs['age'].astype(float)
+
+    return flatten_arr, y_arr
+
+
 def fit_xgb_model(out_fold_num: int, in_fold_num: int, run_cfg: Dict[str, Any], model: XGBModel,
-                  X_train_in: FlattenCorrsDataset, X_val_in: FlattenCorrsDataset) -> Dict:
+                  train_arr: np.ndarray, y_train: np.ndarray, val_arr: np.ndarray, y_val: np.ndarray) -> Dict:
     model_saving_path = create_name_for_xgbmodel(model=model,
                                                  outer_split_num=out_fold_num,
                                                  inner_split_num=in_fold_num,
                                                  run_cfg=run_cfg
                                                  )
 
-    train_arr = np.array([data.x.numpy() for data in X_train_in])
-    val_arr = np.array([data.x.numpy() for data in X_val_in])
-
-    if run_cfg['target_var'] == 'gender':
-        y_train = [int(data.sex.item()) for data in X_train_in]
-        y_val = [int(data.sex.item()) for data in X_val_in]
-    elif run_cfg['target_var'] == 'age':
-        # np.array() because of printing calls in the regressor_metrics function
-        y_train = np.array([float(data.age.item()) for data in X_train_in])
-        y_val = np.array([float(data.age.item()) for data in X_val_in])
-
-    model.fit(train_arr, y_train, callbacks=[wandb.xgboost.wandb_callback()])
+    # Early stopping so that the configurations with many estimators do not run for longer than needed
+    model.fit(train_arr, y_train, eval_set=[(val_arr, y_val)], early_stopping_rounds=20,
+              callbacks=[wandb.xgboost.wandb_callback()])
 
     pickle.dump(model, open(model_saving_path, "wb"))
 
     if run_cfg['target_var'] == 'gender':
         train_metrics = return_classifier_metrics(y_train,
                                                   pred_prob=model.predict_proba(train_arr)[:, 1],
-                                                  pred_binary=model.predict(train_arr),
-                                                  flatten_approach=True)
+                                                  pred_binary=model.predict(train_arr))
         val_metrics = return_classifier_metrics(y_val,
                                                 pred_prob=model.predict_proba(val_arr)[:, 1],
-                                                pred_binary=model.predict(val_arr),
-                                                flatten_approach=True)
+                                                pred_binary=model.predict(val_arr))
 
         print('{:1d}-{:1d}: Auc: {:.4f} / {:.4f}, Acc: {:.4f} / {:.4f}, F1: {:.4f} /'
               ' {:.4f} '.format(out_fold_num, in_fold_num,
@@ -444,16 +567,24 @@ def fit_xgb_model(out_fold_num: int, in_fold_num: int, run_cfg: Dict[str, Any],
 
 
 def fit_st_model(out_fold_num: int, in_fold_num: int, run_cfg: Dict[str, Any], model: SpatioTemporalModel,
-                 X_train_in: BrainDataset, X_val_in: BrainDataset, label_scaler: MinMaxScaler = None) -> Dict:
-    train_in_loader = DataLoader(X_train_in, batch_size=run_cfg['batch_size'], shuffle=True, **kwargs_dataloader)
-    val_loader = DataLoader(X_val_in, batch_size=run_cfg['batch_size'], shuffle=False, **kwargs_dataloader)
+                 train_in_loader: BrainDataLoader, val_loader: BrainDataLoader, label_scaler: MinMaxScaler = None) -> Dict:
+    # Reference to the original model, for naming/saving, as it might be wrapped below
+    base_model: SpatioTemporalModel = model
+    if run_cfg['compile_model']:
+        # Edges change from graph to graph, so shapes are not completely static (thus no CUDA graphs here)
+        model = torch.compile(model)
+
+    if run_cfg['distributed']:
+        model = DistributedDataParallel(model, device_ids=[run_cfg['local_rank']],
+                                        find_unused_parameters=base_model.encoder_model is not None)
 
     optimizer = torch.optim.Adam(model.parameters(),
                                  lr=run_cfg['param_lr'],
                                  weight_decay=run_cfg['param_weight_decay'])
+    scaler = get_grad_scaler(run_cfg['use_amp']) if run_cfg['use_amp'] else None
 
     model_saving_path = create_name_for_model(target_var=run_cfg['target_var'],
-                                              model=model,
+                                              model=base_model,
                                               outer_split_num=out_fold_num,
                                               inner_split_num=in_fold_num,
                                               n_epochs=run_cfg['num_epochs'],
@@ -472,8 +603,11 @@ def fit_st_model(out_fold_num: int, in_fold_num: int, run_cfg: Dict[str, Any], m
 
     best_model_metrics = {'loss': 9999}
 
-    last_losses_val = deque([9999 for _ in range(run_cfg['early_stop_steps'])], maxlen=run_cfg['early_stop_steps'])
+    # Number of consecutive epochs without improving on the best validation loss
+    worse_streak = 0
     for epoch in range(run_cfg['num_epochs'] + 1):
+        if isinstance(train_in_loader.sampler, DistributedSampler):
+            train_in_loader.sampler.set_epoch(epoch)
         val_metrics = training_step(out_fold_num,
                                     in_fold_num,
                                     epoch,
@@ -483,14 +617,21 @@ def fit_st_model(out_fold_num: int, in_fold_num: int, run_cfg: Dict[str, Any], m
                                     optimizer,
                                     run_cfg['param_pooling'],
                                     run_cfg['device_run'],
-                                    label_scaler=label_scaler)
-        if sum([val_metrics['loss'] > loss for loss in last_losses_val]) == run_cfg['early_stop_steps']:
-            print("EARLY STOPPING IT")
-            break
-        last_losses_val.append(val_metrics['loss'])
-
-        if val_metrics['loss'] < best_model_metrics['loss']:
-            best_model_metrics['loss'] = val_metrics['loss']
+                                    label_scaler=label_scaler,
+                                    accum_steps=run_cfg['accum_steps'],
+                                    use_amp=run_cfg['use_amp'],
+                                    scaler=scaler)
+        val_loss = val_metrics['loss']
+        if run_cfg['distributed']:
+            # Validation losses are not bit-identical across ranks (atomic scatter-adds), so every rank follows
+            # rank 0's loss, otherwise one rank might stop early while the others wait for it in the next all-reduce
+            val_loss_t = torch.tensor(float(val_loss), device=run_cfg['device_run'])
+            torch.distributed.broadcast(val_loss_t, src=0)
+            val_loss = val_loss_t.item()
+        # Improvement is checked first, so a NaN loss counts as a worse epoch
+        if val_loss < best_model_metrics['loss']:
+            worse_streak = 0
+            best_model_metrics['loss'] = val_loss
             if label_scaler is None:
                 best_model_metrics['sensitivity'] = val_metrics['sensitivity']
                 best_model_metrics['specificity'] = val_metrics['specificity']
@@ -506,7 +647,13 @@ def fit_st_model(out_fold_num: int, in_fold_num: int, run_cfg: Dict[str, Any], m
 
             # wandb.unwatch()#[model])
             # torch.save(model, model_names['loss'])
-            torch.save(model.state_dict(), model_saving_path)
+            if is_main_process():
+                torch.save(base_model.state_dict(), model_saving_path)
+        else:
+            worse_streak += 1
+            if worse_streak >= run_cfg['early_stop_steps']:
+                print("EARLY STOPPING IT")
+                break
     # wandb.unwatch()
     return best_model_metrics
 
@@ -521,6 +668,8 @@ def get_empty_metrics_dict(run_cfg: Dict[str, Any]) -> Dict[str, list]:
 
 
 def send_inner_loop_metrics_to_wandb(overall_metrics: Dict[str, list]):
+    if not is_main_process():
+        return
     for key, values in overall_metrics.items():
         if len(values) == 0 or values[0] is None:
             continue
@@ -538,6 +687,8 @@ def update_overall_metrics(overall_metrics: Dict[str, list], inner_fold_metrics:
 
 
 def send_global_results(test_metrics: Dict[str, float]):
+    if not is_main_process():
+        return
     for key, value in test_metrics.items():
         wandb.run.summary[f"values_test_{key}"] = value
 
@@ -546,8 +697,22 @@ if __name__ == '__main__':
     # Because of strange bug with symbolic links in server
     os.environ['WANDB_DISABLE_CODE'] = 'true'
 
-    wandb.init(entity='st-team')
-    config = wandb.config
+    # Set by torchrun (or torch.distributed.launch --use_env) when running one process per GPU
+    local_rank = int(os.environ.get('LOCAL_RANK', -1))
+    if local_rank != -1:
+        torch.distributed.init_process_group(backend='nccl')
+        torch.cuda.set_device(local_rank)
+
+    if is_main_process():
+        wandb.init(entity='st-team')
+        config = wandb.config
+    if local_rank != -1:
+        # Only rank 0 talks to wandb (and the sweep controller), the other ranks just receive its config.
+        # broadcast_object_list only available from PyTorch 1.8
+        config_list = [dict(wandb.config) if is_main_process() else None]
+        torch.distributed.broadcast_object_list(config_list, src=0)
+        if not is_main_process():
+            config = WandbConfigDict(config_list[0])
     print('Config file from wandb:', config)
 
     torch.manual_seed(1)
@@ -565,12 +730,30 @@ if __name__ == '__main__':
         'target_var': config.target_var,
         'time_length': config.time_length,
     }
+    run_cfg['local_rank'] = local_rank
+    run_cfg['distributed'] = run_cfg['local_rank'] != -1
+    # Whether this run reserved its GPU through get_freer_gpu() (and so needs to release it at the end)
+    run_cfg['reserved_gpu'] = False
     if run_cfg['analysis_type'] in [AnalysisType.ST_UNIMODAL, AnalysisType.ST_MULTIMODAL]:
         run_cfg['batch_size'] = config.batch_size
-        run_cfg['device_run'] = f'cuda:{get_freer_gpu()}'
+        if run_cfg['distributed']:
+            run_cfg['device_run'] = f'cuda:{run_cfg["local_rank"]}'
+        else:
+            run_cfg['device_run'] = f'cuda:{get_freer_gpu()}'
+            run_cfg['reserved_gpu'] = True
         run_cfg['early_stop_steps'] = config.early_stop_steps
+        # Number of batches whose gradients are accumulated before each optimizer step
+        run_cfg['accum_steps'] = config.get('accum_steps', 1)
+        # torch.compile only available from PyTorch 2.0
+        run_cfg['compile_model'] = config.get('compile_model', False) and hasattr(torch, 'compile')
+        # Mixed precision training, torch.cuda.amp only available from PyTorch 1.6
+        run_cfg['use_amp'] = config.get('use_amp', False) and hasattr(torch.cuda, 'amp')
         run_cfg['edge_weights'] = config.edge_weights
-        run_cfg['model_with_sigmoid'] = True
+        # Classification uses BCEWithLogitsLoss, so the sigmoid is only applied when evaluating
+        run_cfg['model_with_sigmoid'] = False
+        # Saved in the run's config, so post_analysis can recreate the model (and its saving path) with it
+        if is_main_process():
+            wandb.config.update({'model_with_sigmoid': run_cfg['model_with_sigmoid']}, allow_val_change=True)
         run_cfg['num_epochs'] = config.num_epochs
         run_cfg['param_activation'] = config.activation
         run_cfg['param_channels_conv'] = config.channels_conv
@@ -589,7 +772,10 @@ if __name__ == '__main__':
         run_cfg['ts_spit_num'] = int(4800 / run_cfg['time_length'])
 
         # Not sure whether this makes a difference with the cuda random issues, but it was in the examples :(
-        kwargs_dataloader = {'num_workers': 1, 'pin_memory': True} if run_cfg['device_run'].startswith('cuda') else {}
+        kwargs_dataloader = {'num_workers': 4, 'pin_memory': True} if run_cfg['device_run'].startswith('cuda') else {}
+        # Only from PyTorch 1.7: workers are kept alive across epochs and folds, as the loaders are reused
+        if kwargs_dataloader and 'persistent_workers' in inspect.signature(torch.utils.data.DataLoader).parameters:
+            kwargs_dataloader['persistent_workers'] = True
 
         # Definitions depending on sweep_type
         run_cfg['param_gat_heads'] = 0
@@ -597,7 +783,15 @@ if __name__ == '__main__':
             run_cfg['param_gat_heads'] = config.gat_heads
 
     elif run_cfg['analysis_type'] in [AnalysisType.FLATTEN_CORRS]:
-        run_cfg['device_run'] = 'cpu'
+        run_cfg['distributed'] = False
+        if not torch.cuda.is_available():
+            run_cfg['device_run'] = 'cpu'
+        elif 'CUDA_VISIBLE_DEVICES' in os.environ:
+            # Each (concurrent) wandb agent is already pinned to its own GPU, so no need to reserve one
+            run_cfg['device_run'] = 'cuda:0'
+        else:
+            run_cfg['device_run'] = f'cuda:{get_freer_gpu()}'
+            run_cfg['reserved_gpu'] = True
         run_cfg['colsample_bylevel'] = config.colsample_bylevel
         run_cfg['colsample_bynode'] = config.colsample_bynode
         run_cfg['colsample_bytree'] = config.colsample_bytree
@@ -627,14 +821,27 @@ if __name__ == '__main__':
     elif run_cfg['analysis_type'] == AnalysisType.ST_UNIMODAL:
         run_cfg['multimodal_size'] = 0
 
-    if run_cfg['target_var'] in ['age', 'bmi']:
-        run_cfg['model_with_sigmoid'] = False
-
     print('Resulting run_cfg:', run_cfg)
     # DATASET
     dataset = generate_dataset(run_cfg)
+    # Materialising each Data object only once, as slicing (or iterating) an InMemoryDataset rebuilds them every time
+    all_data: List[Data] = [dataset.get(i) for i in range(len(dataset))]
+    data_attrs: Dict[str, np.ndarray] = get_data_attributes(all_data)
+    if run_cfg['analysis_type'] == AnalysisType.FLATTEN_CORRS:
+        flatten_arr, flatten_y = get_array_data(dataset, data_attrs, run_cfg)
+
+    skf_outer_generator = get_fold_splits(dataset, run_cfg, N_OUT_SPLITS, data_attrs=data_attrs,
+                                          cache_dir=dataset.processed_dir, cache_name=f'splits_{N_OUT_SPLITS}')
 
-    skf_outer_generator = create_fold_generator(dataset, run_cfg, N_OUT_SPLITS)
+    if run_cfg['analysis_type'] in [AnalysisType.ST_UNIMODAL, AnalysisType.ST_MULTIMODAL]:
+        # Loaders are created only once: each fold just swaps the indices (of all_data) they sample from
+        train_fold_sampler = FoldSampler(shuffle=True)
+        eval_fold_sampler = FoldSampler(shuffle=False)
+        # Dropping last (smaller) batch avoids a recompilation for a different batch size
+        train_loader = BrainDataLoader(all_data, batch_size=run_cfg['batch_size'], sampler=train_fold_sampler,
+                                       drop_last=run_cfg['compile_model'], **kwargs_dataloader)
+        eval_loader = BrainDataLoader(all_data, batch_size=run_cfg['batch_size'], sampler=eval_fold_sampler,
+                                      **kwargs_dataloader)
 
     # Getting train / test folds
     outer_split_num: int = 0
@@ -644,8 +851,13 @@ if __name__ == '__main__':
         if outer_split_num != run_cfg['split_to_test']:
             continue
 
-        X_train_out = dataset[torch.tensor(train_index)]
-        X_test_out = dataset[torch.tensor(test_index)]
+        X_train_out = [all_data[i] for i in train_index]
+        X_test_out = [all_data[i] for i in test_index]
+        train_out_attrs = slice_data_attributes(data_attrs, train_index)
+        test_out_attrs = slice_data_attributes(data_attrs, test_index)
+        if run_cfg['analysis_type'] == AnalysisType.FLATTEN_CORRS:
+            train_out_arr, y_train_out = flatten_arr[train_index], flatten_y[train_index]
+            test_out_arr, y_test_out = flatten_arr[test_index], flatten_y[test_index]
 
         break
 
@@ -653,29 +865,34 @@ if __name__ == '__main__':
     # Scaling for regression problem
     if run_cfg['analysis_type'] in [AnalysisType.ST_UNIMODAL, AnalysisType.ST_MULTIMODAL] and \
             run_cfg['target_var'] in ['age', 'bmi']:
-        print('Mean of distribution BEFORE scaling:', np.mean([data.y.item() for data in X_train_out]),
-              '/', np.mean([data.y.item() for data in X_test_out]))
-        scaler_labels = MinMaxScaler().fit(np.array([data.y.item() for data in X_train_out]).reshape(-1, 1))
+        print('Mean of distribution BEFORE scaling:', np.mean(train_out_attrs['y']),
+              '/', np.mean(test_out_attrs['y']))
+        scaler_labels = MinMaxScaler().fit(train_out_attrs['y'].reshape(-1, 1))
         for elem in X_train_out:
             elem.y[0] = scaler_labels.transform([elem.y.numpy()])[0, 0]
         for elem in X_test_out:
             elem.y[0] = scaler_labels.transform([elem.y.numpy()])[0, 0]
+        # Keeping the cached labels consistent with the scaled ones
+        train_out_attrs['y'] = scaler_labels.transform(train_out_attrs['y'].reshape(-1, 1))[:, 0]
+        test_out_attrs['y'] = scaler_labels.transform(test_out_attrs['y'].reshape(-1, 1))[:, 0]
 
     # Train / test sets defined, running the rest
     print('Size is:', len(X_train_out), '/', len(X_test_out))
     if run_cfg['analysis_type'] == AnalysisType.FLATTEN_CORRS:
-        print('Positive sex classes:', sum([data.sex.item() for data in X_train_out]),
-              '/', sum([data.sex.item() for data in X_test_out]))
-        print('Mean age distribution:', np.mean([data.age.item() for data in X_train_out]),
-              '/', np.mean([data.age.item() for data in X_test_out]))
+        print('Positive sex classes:', np.sum(train_out_attrs['sex']),
+              '/', np.sum(test_out_attrs['sex']))
+        print('Mean age distribution:', np.mean(train_out_attrs['age']),
+              '/', np.mean(test_out_attrs['age']))
     elif run_cfg['target_var'] in ['age', 'bmi']:
-        print('Mean of distribution', np.mean([data.y.item() for data in X_train_out]),
-              '/', np.mean([data.y.item() for data in X_test_out]))
+        print('Mean of distribution', np.mean(train_out_attrs['y']),
+              '/', np.mean(test_out_attrs['y']))
     else:  # target_var == gender
-        print('Positive classes:', sum([data.y.item() for data in X_train_out]),
-              '/', sum([data.y.item() for data in X_test_out]))
+        print('Positive classes:', np.sum(train_out_attrs['y']),
+              '/', np.sum(test_out_attrs['y']))
 
-    skf_inner_generator = create_fold_generator(X_train_out, run_cfg, N_INNER_SPLITS)
+    skf_inner_generator = get_fold_splits(X_train_out, run_cfg, N_INNER_SPLITS, data_attrs=train_out_attrs,
+                                          cache_dir=dataset.processed_dir,
+                                          cache_name=f'splits_{N_OUT_SPLITS}_{outer_split_num}_{N_INNER_SPLITS}')
 
     #################
     # Main inner-loop
@@ -692,28 +909,40 @@ if __name__ == '__main__':
         else:
             model = None
 
-        X_train_in = X_train_out[torch.tensor(inner_train_index)]
-        X_val_in = X_train_out[torch.tensor(inner_val_index)]
-        print("Inner Size is:", len(X_train_in), "/", len(X_val_in))
+        train_in_attrs = slice_data_attributes(train_out_attrs, inner_train_index)
+        val_in_attrs = slice_data_attributes(train_out_attrs, inner_val_index)
+        print("Inner Size is:", len(inner_train_index), "/", len(inner_val_index))
         if run_cfg['analysis_type'] == AnalysisType.FLATTEN_CORRS:
-            print("Inner Positive sex classes:", sum([data.sex.item() for data in X_train_in]),
-                  "/", sum([data.sex.item() for data in X_val_in]))
-            print('Mean age distribution:', np.mean([data.age.item() for data in X_train_in]),
-                  '/', np.mean([data.age.item() for data in X_val_in]))
+            print("Inner Positive sex classes:", np.sum(train_in_attrs['sex']),
+                  "/", np.sum(val_in_attrs['sex']))
+            print('Mean age distribution:', np.mean(train_in_attrs['age']),
+                  '/', np.mean(val_in_attrs['age']))
         elif run_cfg['target_var'] in ['age', 'bmi']:
-            print('Mean of distribution', np.mean([data.y.item() for data in X_train_in]),
-                  '/', np.mean([data.y.item() for data in X_val_in]))
+            print('Mean of distribution', np.mean(train_in_attrs['y']),
+                  '/', np.mean(val_in_attrs['y']))
         else:
-            print("Inner Positive classes:", sum([data.y.item() for data in X_train_in]),
-                  "/", sum([data.y.item() for data in X_val_in]))
+            print("Inner Positive classes:", np.sum(train_in_attrs['y']),
+                  "/", np.sum(val_in_attrs['y']))
 
         if run_cfg['analysis_type'] in [AnalysisType.ST_UNIMODAL, AnalysisType.ST_MULTIMODAL]:
+            if run_cfg['distributed']:
+                # One process per GPU, each one training on its own shard of the training set
+                X_train_in = [all_data[i] for i in train_index[inner_train_index]]
+                train_in_loader = BrainDataLoader(X_train_in, batch_size=run_cfg['batch_size'],
+                                                  sampler=DistributedSampler(X_train_in, shuffle=True),
+                                                  drop_last=run_cfg['compile_model'], **kwargs_dataloader)
+            else:
+                train_fold_sampler.indices = train_index[inner_train_index]
+                train_in_loader = train_loader
+            # Validation set is evaluated entirely by every process, so early stopping decisions stay in sync
+            eval_fold_sampler.indices = train_index[inner_val_index]
+
             inner_fold_metrics = fit_st_model(out_fold_num=run_cfg['split_to_test'],
                                               in_fold_num=inner_loop_run,
                                               run_cfg=run_cfg,
                                               model=model,
-                                              X_train_in=X_train_in,
-                                              X_val_in=X_val_in,
+                                              train_in_loader=train_in_loader,
+                                              val_loader=eval_loader,
                                               label_scaler=scaler_labels)
 
         elif run_cfg['analysis_type'] in [AnalysisType.FLATTEN_CORRS]:
@@ -721,10 +950,18 @@ if __name__ == '__main__':
                                                in_fold_num=inner_loop_run,
                                                run_cfg=run_cfg,
                                                model=model,
-                                               X_train_in=X_train_in,
-                                               X_val_in=X_val_in)
+                                               train_arr=train_out_arr[inner_train_index],
+                                               y_train=y_train_out[inner_train_index],
+                                               val_arr=train_out_arr[inner_val_index],
+                                               y_val=y_train_out[inner_val_index])
         update_overall_metrics(overall_metrics, inner_fold_metrics)
 
+        # Releasing this fold's model before the next one is allocated, to keep the GPU memory peak low
+        del model
+        gc.collect()
+        if run_cfg['device_run'].startswith('cuda'):
+            torch.cuda.empty_cache()
+
         # One inner loop only
         #if run_cfg['dataset_type'] == DatasetType.UKB and run_cfg['analysis_type'] in [AnalysisType.ST_UNIMODAL,
         #                                                                               AnalysisType.ST_MULTIMODAL]:
@@ -733,6 +970,9 @@ if __name__ == '__main__':
         break
 
     send_inner_loop_metrics_to_wandb(overall_metrics)
+    if run_cfg['distributed']:
+        # Making sure rank 0 has finished saving the best model before everyone loads it
+        torch.distributed.barrier()
     print('Overall inner loop results:', overall_metrics)
 
     #############################################
@@ -758,14 +998,14 @@ if __name__ == '__main__':
                                                        lr=run_cfg['param_lr'],
                                                        weight_decay=run_cfg['param_weight_decay'],
                                                        edge_weights=run_cfg['edge_weights'])
-        model.load_state_dict(torch.load(model_saving_path))
+        model.load_state_dict(torch.load(model_saving_path, map_location=run_cfg['device_run']))
         model.eval()
 
         # Calculating on test set
-        test_out_loader = DataLoader(X_test_out, batch_size=run_cfg['batch_size'], shuffle=False, **kwargs_dataloader)
+        eval_fold_sampler.indices = test_index
 
-        test_metrics = evaluate_model(model, test_out_loader, run_cfg['param_pooling'], run_cfg['device_run'],
-                                      label_scaler=scaler_labels)
+        test_metrics = evaluate_model(model, eval_loader, run_cfg['param_pooling'], run_cfg['device_run'],
+                                      label_scaler=scaler_labels, use_amp=run_cfg['use_amp'])
         print(test_metrics)
 
         if scaler_labels is None:
@@ -783,24 +1023,19 @@ if __name__ == '__main__':
                                                      run_cfg=run_cfg
                                                      )
         model = pickle.load(open(model_saving_path, "rb"))
-        test_arr = np.array([data.x.numpy() for data in X_test_out])
 
         if run_cfg['target_var'] == 'gender':
-            y_test = [int(data.sex.item()) for data in X_test_out]
-            test_metrics = return_classifier_metrics(y_test,
-                                                     pred_prob=model.predict_proba(test_arr)[:, 1],
-                                                     pred_binary=model.predict(test_arr),
-                                                     flatten_approach=True)
+            test_metrics = return_classifier_metrics(y_test_out,
+                                                     pred_prob=model.predict_proba(test_out_arr)[:, 1],
+                                                     pred_binary=model.predict(test_out_arr))
             print(test_metrics)
 
             print('{:1d}-Final: Auc: {:.4f}, Acc: {:.4f}, Sens: {:.4f}, Speci: {:.4f}'
                   ''.format(outer_split_num, test_metrics['auc'], test_metrics['acc'],
                             test_metrics['sensitivity'], test_metrics['specificity']))
         elif run_cfg['target_var'] == 'age':
-            # np.array() because of printing calls in the regressor_metrics function
-            y_test = np.array([float(data.age.item()) for data in X_test_out])
-            test_metrics = return_regressor_metrics(y_test,
-                                                    pred_prob=model.predict(test_arr))
+            test_metrics = return_regressor_metrics(y_test_out,
+                                                    pred_prob=model.predict(test_out_arr))
             print(test_metrics)
             print('{:1d}-Final: R2: {:.4f}, R: {:.4f}'.format(outer_split_num,
                                                               test_metrics['r2'],
@@ -808,5 +1043,7 @@ if __name__ == '__main__':
 
     send_global_results(test_metrics)
 
-    if run_cfg['device_run'] == 'cuda:0':
+    if local_rank != -1:
+        torch.distributed.destroy_process_group()
+    elif run_cfg['reserved_gpu'] and run_cfg['device_run'] == 'cuda:0':
         free_gpu_info()
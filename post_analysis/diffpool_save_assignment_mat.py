@@ -67,7 +67,7 @@ for model_type, runs_all in best_runs.items():
             if outer_split_num != w_config['fold_num']:
                 continue
 
-            X_test_out = dataset[torch.tensor(test_index)]
+            X_test_out = dataset[torch.from_numpy(np.asarray(test_index, dtype=np.int64))]
 
             break
 
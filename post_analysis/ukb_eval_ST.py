@@ -92,7 +92,8 @@ for model_type, runs_all in best_runs.items():
             w_config['param_lr'] = w_config['lr']
         else:
             w_config['param_lr'] = float(run_info['lr'])
-        w_config['model_with_sigmoid'] = True
+        # Stored in the config from the BCEWithLogitsLoss change onwards (older runs always had the final sigmoid)
+        w_config['model_with_sigmoid'] = w_config.get('model_with_sigmoid', True)
         w_config['param_activation'] = w_config['activation']
         w_config['param_channels_conv'] = w_config['channels_conv']
         w_config['param_conn_type'] = ConnType(w_config['conn_type'])
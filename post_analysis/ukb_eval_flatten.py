@@ -69,8 +69,7 @@ for model_type, runs_all in best_runs.items():
 
         test_metrics = return_classifier_metrics(hcp_y_test,
                                                  pred_prob=model.predict_proba(hcp_arr)[:, 1],
-                                                 pred_binary=model.predict(hcp_arr),
-                                                 flatten_approach=True)
+                                                 pred_binary=model.predict(hcp_arr))
         for metric in metrics_hcp.keys():
             metrics_hcp[metric].append(test_metrics[metric])
 
@@ -1,12 +1,12 @@
 import random
-from collections import Counter, defaultdict
+from collections import defaultdict
+from contextlib import nullcontext
 from enum import Enum, unique
 from typing import NoReturn, Dict, Any
 
 import fcntl
 import numpy as np
 import torch
-from sklearn.preprocessing import LabelEncoder
 from xgboost import XGBModel
 
 
@@ -125,10 +125,68 @@ def free_gpu_info() -> NoReturn:
         fcntl.flock(fd, fcntl.LOCK_UN)
 
 
+def is_main_process() -> bool:
+    """
+    When running with torch.distributed (e.g. launched by torchrun) only rank 0 should log or save files.
+    :return:
+    """
+    if not torch.distributed.is_available() or not torch.distributed.is_initialized():
+        return True
+    return torch.distributed.get_rank() == 0
+
+
+class WandbConfigDict(dict):
+    """
+    Plain copy of a wandb.config, with the same attribute access, for the ranks which did not call wandb.init.
+    """
+
+    def __getattr__(self, key):
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key)
+
+
+def get_autocast_context(use_amp: bool):
+    if not use_amp:
+        return nullcontext()
+    # BF16 (Ampere onwards) has the same range as FP32, so no loss scaling is needed
+    if getattr(torch.cuda, 'is_bf16_supported', lambda: False)():
+        return torch.cuda.amp.autocast(dtype=torch.bfloat16)
+    return torch.cuda.amp.autocast()
+
+
+def get_grad_scaler(use_amp: bool):
+    # Only FP16 needs loss scaling (a disabled GradScaler just passes everything through)
+    return torch.cuda.amp.GradScaler(
+        enabled=use_amp and not getattr(torch.cuda, 'is_bf16_supported', lambda: False)())
+
+
+class FoldSampler(torch.utils.data.Sampler):
+    """
+    Samples from a mutable list of indices of the whole dataset, so the same DataLoader (and its workers) can be reused
+    across folds by just swapping the indices.
+    """
+
+    def __init__(self, indices=(), shuffle: bool = False):
+        super(FoldSampler, self).__init__(None)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.shuffle = shuffle
+
+    def __iter__(self):
+        if self.shuffle:
+            return iter(self.indices[torch.randperm(len(self.indices)).numpy()].tolist())
+        return iter(self.indices.tolist())
+
+    def __len__(self):
+        return len(self.indices)
+
+
 def merge_y_and_others(ys, indices):
     tmp = torch.cat([ys.long().view(-1, 1),
                      indices.view(-1, 1)], dim=1)
-    return LabelEncoder().fit_transform([str(l) for l in tmp.numpy()])
+    # Each distinct (y, index) row gets its own label, in 0..num_labels-1
+    return np.unique(tmp.numpy(), axis=0, return_inverse=True)[1].reshape(-1)
 
 
 def create_name_for_flattencorrs_dataset(run_cfg: Dict[str, Any]) -> str:
@@ -229,7 +287,8 @@ def change_w_config_(w_config):
     w_config['analysis_type'] = AnalysisType(w_config['analysis_type'])
     w_config['dataset_type'] = DatasetType(w_config['dataset_type'])
     w_config['param_lr'] = w_config['lr']
-    w_config['model_with_sigmoid'] = True
+    # Stored in the config from the BCEWithLogitsLoss change onwards (older runs always had the final sigmoid)
+    w_config['model_with_sigmoid'] = w_config.get('model_with_sigmoid', True)
     w_config['param_activation'] = w_config['activation']
     w_config['param_channels_conv'] = w_config['channels_conv']
     w_config['param_conn_type'] = ConnType(w_config['conn_type'])
@@ -256,6 +315,33 @@ def change_w_config_(w_config):
     if w_config['target_var'] in ['age', 'bmi']:
         w_config['model_with_sigmoid'] = False
 
+def _assign_folds(y_counts_sorted, y_distr, n_splits):
+    """
+    Greedily assigns each group (already sorted) to the fold which keeps the label distribution the most even across
+    folds, i.e., minimising the mean (over labels) of the std (over folds) of the ratios of each label.
+    :param y_counts_sorted: (num_groups, labels_num) array with the label counts of each group
+    :param y_distr: (labels_num,) array with the label counts of the whole dataset
+    :return: fold of each group
+    """
+    num_groups, labels_num = y_counts_sorted.shape
+    # Shape (labels_num, n_splits), so the std of each label is over a contiguous row
+    y_counts_per_fold = np.zeros((labels_num, n_splits))
+    best_folds = np.zeros(num_groups, dtype=np.int64)
+    for g in range(num_groups):
+        min_eval = None
+        for i in range(n_splits):
+            y_counts_per_fold[:, i] += y_counts_sorted[g]
+            # Must be np.mean over the stds of all labels: near-ties between folds depend on numpy's summation order,
+            # and any change here changes the folds (and then FOLD_SPLITS_VERSION in main_loop.py needs to increase)
+            fold_eval = np.mean(np.std(y_counts_per_fold / y_distr[:, np.newaxis], axis=1))
+            y_counts_per_fold[:, i] -= y_counts_sorted[g]
+            if min_eval is None or fold_eval < min_eval:
+                min_eval = fold_eval
+                best_folds[g] = i
+        y_counts_per_fold[:, best_folds[g]] += y_counts_sorted[g]
+    return best_folds
+
+
 # From https://www.kaggle.com/jakubwasikowski/stratified-group-k-fold-cross-validation
 class StratifiedGroupKFold:
 
@@ -266,43 +352,22 @@ class StratifiedGroupKFold:
     def split(self, X, y, groups):
         labels_num = np.max(y) + 1
         y_counts_per_group = defaultdict(lambda: np.zeros(labels_num))
-        y_distr = Counter()
         for label, g in zip(y, groups):
             y_counts_per_group[g][label] += 1
-            y_distr[label] += 1
-
-        y_counts_per_fold = defaultdict(lambda: np.zeros(labels_num))
-        groups_per_fold = defaultdict(set)
-
-        def eval_y_counts_per_fold(y_counts, fold):
-            y_counts_per_fold[fold] += y_counts
-            std_per_label = []
-            for label in range(labels_num):
-                label_std = np.std([y_counts_per_fold[i][label] / y_distr[label] for i in range(self.n_splits)])
-                std_per_label.append(label_std)
-            y_counts_per_fold[fold] -= y_counts
-            return np.mean(std_per_label)
+        y_distr = np.bincount(np.asarray(y), minlength=labels_num)
 
         groups_and_y_counts = list(y_counts_per_group.items())
         random.Random(self.random_state).shuffle(groups_and_y_counts)
+        groups_and_y_counts = sorted(groups_and_y_counts, key=lambda x: -np.std(x[1]))
 
-        for g, y_counts in sorted(groups_and_y_counts, key=lambda x: -np.std(x[1])):
-            best_fold = None
-            min_eval = None
-            for i in range(self.n_splits):
-                fold_eval = eval_y_counts_per_fold(y_counts, i)
-                if min_eval is None or fold_eval < min_eval:
-                    min_eval = fold_eval
-                    best_fold = i
-            y_counts_per_fold[best_fold] += y_counts
-            groups_per_fold[best_fold].add(g)
-
-        all_groups = set(groups)
-        for i in range(self.n_splits):
-            train_groups = all_groups - groups_per_fold[i]
-            test_groups = groups_per_fold[i]
+        best_folds = _assign_folds(np.array([y_counts for _, y_counts in groups_and_y_counts]),
+                                   y_distr.astype(np.float64), self.n_splits)
+        fold_per_group = {g: best_fold for (g, _), best_fold in zip(groups_and_y_counts, best_folds)}
+        # Single pass over groups, then each split is just a (sorted) search in this array
+        fold_per_index = np.array([fold_per_group[g] for g in groups])
 
-            train_indices = [i for i, g in enumerate(groups) if g in train_groups]
-            test_indices = [i for i, g in enumerate(groups) if g in test_groups]
+        for i in range(self.n_splits):
+            train_indices = np.flatnonzero(fold_per_index != i)
+            test_indices = np.flatnonzero(fold_per_index == i)
 
             yield train_indices, test_indices